@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+import calendar_loader, renderer, display, font_cache
+import argparse, datetime, http.server, os, random, resource, statistics, tempfile, threading, time
+
+## Benchmarks the whole refresh pipeline on synthetic calendars, without a panel. Each fixture is served
+## over a local HTTP server and run through every stage of a refresh:
+##   fetch      CalendarCache streaming the ICS text into its cache
+##   parse      reading it back line by line, pruning/expanding events to the drawn window
+##   index      building the per-date EventIndex
+##   layout     building a CalendarRenderer from scratch (geometry; its fonts are loaded by its first render)
+##   rasterize  drawing the frame
+##   output     handing the frame to an output backend (a PNG file)
+## along with the peak resident set size of the process once each fixture is done. That's a high-water mark
+## for the whole run so far, so for a fixture's own peak run it on its own with --fixtures.
+
+## name, number of events, whether they're all piled onto the day being drawn
+fixtures = [
+    ('small', 10, False),
+    ('medium', 100, False),
+    ('large', 1000, False),
+    ('huge', 10000, False),
+    ('enormous', 50000, False),
+    ('dense-day', 50, True),
+    ('dense-day-large', 500, True),
+]
+stages = ['fetch', 'parse', 'index', 'layout', 'rasterize', 'output']
+
+## An ICS calendar of eventCount events. Normally they're spread over two years either side of today, a tenth
+## of them all-day and a twentieth weekly series, so most fall outside the drawn month; with denseDay they are
+## instead overlapping timed events all on today, the worst case for the day view.
+def makeSyntheticCalendar(eventCount, today, denseDay=False, seed=None):
+    rand = random.Random(seed)
+    stamp = '20230101T000000Z'
+    lines = ['BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//rpiz-epaper-calendar//benchmark//EN']
+    for idx in range(eventCount):
+        lines += ['BEGIN:VEVENT', 'UID:bench-{:d}@rpiz-epaper-calendar'.format(idx), 'DTSTAMP:{:s}'.format(stamp),
+                  'SUMMARY:Synthetic event {:d} with a reasonably long meeting title'.format(idx)]
+        if denseDay:
+            start = datetime.datetime.combine(today, datetime.time(hour=8)) + datetime.timedelta(minutes=rand.randrange(0, 10*60, 15))
+            end = start + datetime.timedelta(minutes=rand.choice([15, 30, 60, 90, 120]))
+        else:
+            day = today + datetime.timedelta(days=rand.randrange(-730, 730))
+            if idx % 10 == 0:
+                lines += ['DTSTART;VALUE=DATE:{:s}'.format(day.strftime('%Y%m%d')),
+                          'DTEND;VALUE=DATE:{:s}'.format((day + datetime.timedelta(days=rand.randint(1, 3))).strftime('%Y%m%d')),
+                          'END:VEVENT']
+                continue
+            start = datetime.datetime.combine(day, datetime.time(hour=rand.randrange(7, 19), minute=rand.choice([0, 15, 30, 45])))
+            end = start + datetime.timedelta(minutes=rand.choice([30, 60, 90]))
+            if idx % 20 == 1:
+                lines.append('RRULE:FREQ=WEEKLY;COUNT={:d}'.format(rand.randint(5, 100)))
+        lines += ['DTSTART:{:s}'.format(start.strftime('%Y%m%dT%H%M%S')), 'DTEND:{:s}'.format(end.strftime('%Y%m%dT%H%M%S')),
+                  'END:VEVENT']
+    lines.append('END:VCALENDAR')
+    return '\r\n'.join(lines) + '\r\n'
+
+## Serves the given {path: text} over HTTP on a free local port, in a background thread
+def serveFixtures(fixtureData):
+    class FixtureHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = fixtureData.get(self.path)
+            if body is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/calendar')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, format, *args):
+            pass
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FixtureHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def timed(timings, stage, func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    timings.setdefault(stage, []).append(time.perf_counter() - start)
+    return result
+
+## Run one fixture through every stage repeat times, returning {stage: [seconds, ...]} and the event count drawn
+def benchmarkFixture(url, now, fontbasedir, outputDir, repeat):
+    timings = {}
+    datesDrawn = renderer.getDatesDrawn(now.date())
+    windowEnd = datesDrawn[-1] + datetime.timedelta(days=1)
+    ## Shared between runs the way a long-lived renderer shares it between frames; only the first run draws the static layer
+    layers = renderer.StaticLayerCache()
+    for iteration in range(repeat):
+        ## Expiring immediately, and never served stale, so every run downloads the calendar again
+        calendarCache = calendar_loader.CalendarCache(url, cache_dir=outputDir, cache_expiry=datetime.timedelta(0),
+                                                      stale_while_revalidate=datetime.timedelta(0))
+        digest, lines = timed(timings, 'fetch', calendarCache.get_lines)
+        events = timed(timings, 'parse', calendar_loader.parse_events, lines, datesDrawn[0], windowEnd)
+        eventIndex = timed(timings, 'index', calendar_loader.EventIndex, events, datesDrawn[0], datesDrawn[-1])
+        calendarRenderer = timed(timings, 'layout', renderer.CalendarRenderer, 800, 480, fontbasedir, fonts=font_cache.FontCache(), layers=layers)
+        image = timed(timings, 'rasterize', calendarRenderer.render, now, eventIndex)
+        planner = display.RefreshPlanner(display.PngFileBackend(800, 480, os.path.join(outputDir, 'frame.png')))
+        timed(timings, 'output', planner.present, image)
+    return timings, len(events)
+
+if __name__ == '__main__':
+    home = os.path.abspath(os.path.dirname(__file__))
+    parser = argparse.ArgumentParser(description='Time each stage of a calendar refresh against synthetic calendars')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per fixture; the median is reported. Default 3')
+    parser.add_argument('--fixtures', help='Comma separated fixture names to run; default all of ' + ', '.join(fixture[0] for fixture in fixtures))
+    parser.add_argument('--fonts', default=os.path.join(home, 'fonts'), help='Directory holding the calendar fonts')
+    parser.add_argument('--date', default='2026-10-18T11:30:00', help='The day to draw, in yyyy-mm-ddThh:mm:ss format')
+    args = parser.parse_args()
+
+    now = datetime.datetime.strptime(args.date, '%Y-%m-%dT%H:%M:%S')
+    selected = fixtures if args.fixtures is None else [fixture for fixture in fixtures if fixture[0] in args.fixtures.split(',')]
+    fixtureData = {'/{:s}.ics'.format(name): makeSyntheticCalendar(count, now.date(), denseDay=dense, seed=name).encode()
+                   for name, count, dense in selected}
+    server = serveFixtures(fixtureData)
+    print('{:16s} {:>7s} {:>7s} {:>9s}'.format('fixture', 'events', 'drawn', 'size') + ''.join(' {:>10s}'.format(stage) for stage in stages)
+          + ' {:>9s}'.format('peak RSS'))
+    try:
+        with tempfile.TemporaryDirectory() as outputDir:
+            for name, count, dense in selected:
+                path = '/{:s}.ics'.format(name)
+                url = 'http://127.0.0.1:{:d}{:s}'.format(server.server_address[1], path)
+                try:
+                    timings, drawn = benchmarkFixture(url, now, args.fonts, outputDir, max(args.repeat, 1))
+                except Exception as e:
+                    print('{:16s} {:7d} failed: {}'.format(name, count, e))
+                    continue
+                print('{:16s} {:7d} {:7d} {:8.0f}K'.format(name, count, drawn, len(fixtureData[path])/1024.0)
+                      + ''.join(' {:8.1f}ms'.format(statistics.median(timings[stage])*1000) for stage in stages)
+                      # ru_maxrss is in kilobytes on Linux
+                      + ' {:7.1f}MB'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0))
+    finally:
+        server.shutdown()
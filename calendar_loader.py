@@ -1,5 +1,8 @@
 #!/usr/bin/env python3
-import requests, icalendar, argparse, datetime, time, json, hashlib, sys, os
+import zoneinfo, argparse, contextlib, datetime, time, json, hashlib, sys, io, os, re, bisect, fcntl, tempfile, threading, concurrent.futures
+## requests, icalendar and dateutil are slow to import on a Pi Zero, so they're imported where they're used; a run
+## where every calendar is fresh in the cache and already parsed never loads them at all
+import metrics
 
 def currenttz():
     if time.daylight:
@@ -10,24 +13,238 @@ def currenttz():
 dateformat = '%Y-%m-%d'
 timeformat = '%Y-%m-%d %H:%M:%S %z'
 
+## Dates serialize as yyyy-mm-dd, datetimes as full ISO timestamps
+def parseIsoDateOrDatetime(isoStr):
+    if len(isoStr) == len('yyyy-mm-dd'):
+        return datetime.date.fromisoformat(isoStr)
+    return datetime.datetime.fromisoformat(isoStr)
+
+## One keep-alive session shared by every calendar, so repeated fetches from the same host reuse their connection
+http_session = None
+
+def get_http_session():
+    global http_session
+    if http_session is None:
+        import requests
+        http_session = requests.Session()
+    return http_session
+
+## Pull max-age (in seconds) out of a Cache-Control header, if it has one
+def parse_max_age(cache_control):
+    if cache_control is None:
+        return None
+    match = re.search(r'(?:^|,)\s*max-age\s*=\s*"?(\d+)', cache_control, re.IGNORECASE)
+    if match is None:
+        return None
+    return int(match.group(1))
+
+## Dates and datetimes can't be compared with each other, so both become aware datetimes;
+## dates (and floating times) are taken as local, a date meaning its local midnight
+def toComparable(dateOrDatetime):
+    if type(dateOrDatetime) is datetime.date:
+        return datetime.datetime(dateOrDatetime.year, dateOrDatetime.month, dateOrDatetime.day).astimezone()
+    if dateOrDatetime.tzinfo is None:
+        return dateOrDatetime.astimezone()
+    return dateOrDatetime
+
+## What to log about an exception. requests quotes the URL in its exceptions, and a private feed's URL carries its
+## access token, so they're only described by type (and HTTP status, if there was a response)
+def describe_error(e):
+    if not hasattr(e, 'request'):
+        return str(e)
+    response = getattr(e, 'response', None)
+    if response is not None:
+        return '{:s} {:d}'.format(type(e).__name__, response.status_code)
+    return type(e).__name__
+
+## What a newly created file's permissions would be; read once at import, as reading the umask means briefly changing it
+process_umask = os.umask(0)
+os.umask(process_umask)
+default_file_mode = 0o666 & ~process_umask
+
+## Replace path so it's always either all of the old file or all of the new one, even across a power cut: the new
+## contents are written to a temporary file beside it and synced to disk before being renamed over it, and the
+## directory is synced after so the rename itself sticks. The new file keeps the old one's permissions (or those
+## a plain open would give it), so processes running as other users can still read it.
+@contextlib.contextmanager
+def atomic_write(path, mode='w'):
+    directory = os.path.dirname(path)
+    try:
+        file_mode = os.stat(path).st_mode & 0o777
+    except FileNotFoundError:
+        file_mode = default_file_mode
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.{:s}.'.format(os.path.basename(path)), suffix='.tmp')
+    try:
+        os.fchmod(fd, file_mode)
+        with os.fdopen(fd, mode) as outfil:
+            yield outfil
+            outfil.flush()
+            os.fsync(outfil.fileno())
+        os.replace(temp_path, path)
+    except:
+        os.remove(temp_path)
+        raise
+    directory_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(directory_fd)
+    finally:
+        os.close(directory_fd)
+
+## Hold an exclusive lock on path (created if need be) for the duration; yields whether the lock was got, which
+## without blocking is False if someone else already has it
+@contextlib.contextmanager
+def locked_file(path, blocking=True):
+    with open(path, 'a') as lockfil:
+        try:
+            fcntl.flock(lockfil, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lockfil, fcntl.LOCK_UN)
+
+## What a cache description file holds; the body itself is in a file of its own
+cache_file_keys = ('last_update', 'sha256', 'bytes', 'encoding', 'etag', 'last_modified', 'max_age')
+
+## Fetches a calendar, keeping it in cache_dir. A cached copy is used for cache_expiry (or the server's max-age);
+## once it's into the last refresh_ahead of that time it's still used, but refreshed in the background so it
+## doesn't expire in front of a refresh. For stale_while_revalidate after it does expire, it's still used while
+## it's refreshed in the background; after that the fetch happens before anything is returned. Fetching is done
+## under a file lock, so other threads and processes using the same cache_dir never fetch the same calendar at once.
 class CalendarCache(object):
-    def __init__(self, url, cache_dir=None, cache_expiry=None):
+    def __init__(self, url, cache_dir=None, cache_expiry=None, minimum_cache_expiry=None, timeout=None,
+                 refresh_ahead=None, stale_while_revalidate=None):
         self.url = url
         self.cache_dir = cache_dir
+        if timeout is None:
+            timeout = 30
+        self.timeout = timeout
         if cache_expiry is None:
             cache_expiry = datetime.timedelta(hours=1)
         self.cache_expiry = cache_expiry
-        self.cache_file = '{}.json'.format(hashlib.sha256(url.encode()).hexdigest())
+        ## Servers that say max-age=0 are still only asked this often (cheaply, with a conditional request)
+        if minimum_cache_expiry is None:
+            minimum_cache_expiry = datetime.timedelta(minutes=5)
+        self.minimum_cache_expiry = minimum_cache_expiry
+        ## A fraction of the expiry time
+        if refresh_ahead is None:
+            refresh_ahead = 0.25
+        self.refresh_ahead = refresh_ahead
+        if stale_while_revalidate is None:
+            stale_while_revalidate = datetime.timedelta(minutes=30)
+        self.stale_while_revalidate = stale_while_revalidate
+        url_hash = hashlib.sha256(url.encode()).hexdigest()
+        ## The body is kept as it came off the wire, next to a small JSON file describing it, so it can be
+        ## read back a line at a time rather than loaded whole
+        self.cache_file = '{}.json'.format(url_hash)
+        self.body_file = '{}.ics'.format(url_hash)
+        self.lock_file = '{}.lock'.format(url_hash)
+        ## Private feed URLs carry their access token, so metrics name a calendar by the start of the hash its
+        ## cache files are named with instead
+        self.label = url_hash[:12]
+        self.revalidating = False
+        self.revalidating_lock = threading.Lock()
 
     def get(self):
-        if self.cache_dir is not None:
-            return self.__get_cache_enabled()
-        return self.__retrieve_url_data()
-        
-    ## Perform the logic of checking the cache (using self.cache_dir)
-    def __get_cache_enabled(self):
-        now = datetime.datetime.now(currenttz())
-        file_data = {'last_update':now.strftime(timeformat), 'data':None}
+        digest, lines = self.get_lines()
+        return ''.join(lines)
+
+    ## The calendar as (digest, lines); digest is the SHA-256 of the body (None without a cache_dir), and lines
+    ## iterates over its lines, read from the cached copy only as they're asked for. A background refresh
+    ## can swap the body in between; that only costs the parsed-event cache a miss on the next refresh.
+    def get_lines(self):
+        with metrics.span('calendar_cache.get', calendar=self.label) as span:
+            if self.cache_dir is None:
+                span.set(result='uncached')
+                text = self.__get_text(self.__retrieve_url_response())
+                span.set(bytes=len(text))
+                return None, io.StringIO(text)
+            file_data = self.__get_cache_enabled(span)
+            span.set(bytes=file_data['bytes'])
+            return file_data['sha256'], self.__read_body(file_data['encoding'])
+
+    ## Perform the logic of checking the cache (using self.cache_dir), returning the cached file's
+    ## description; how the body was found (hit, miss, revalidated or stale) is recorded on span
+    def __get_cache_enabled(self, span):
+        file_data = self.__load_file_data()
+        if file_data.get('sha256') is not None:
+            age = self.__get_age(file_data)
+            expiry = self.__get_expiry(file_data)
+            if age < expiry:
+                span.set(result='hit')
+                if age >= expiry*(1-self.refresh_ahead):
+                    self.__revalidate_in_background()
+                return file_data
+            if age < expiry + self.stale_while_revalidate:
+                span.set(result='stale')
+                self.__revalidate_in_background()
+                return file_data
+        return self.__refresh(span, 1)
+
+    ## Fetch the calendar if the cached copy is older than fraction of its expiry time, returning the cache's
+    ## description. Whoever gets the lock first fetches, and anyone who waited on it then finds the cache fresh;
+    ## without blocking, None is returned straight away if someone else is already fetching.
+    def __refresh(self, span, fraction, blocking=True):
+        import requests
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with locked_file(os.path.join(self.cache_dir, self.lock_file), blocking=blocking) as locked:
+            if not locked:
+                return None
+            file_data = self.__load_file_data()
+            if file_data.get('sha256') is not None and self.__get_age(file_data) < self.__get_expiry(file_data)*fraction:
+                span.set(result='hit')
+                return file_data
+            now = datetime.datetime.now(currenttz())
+            ## Only offer validators if we still have the body they validate
+            try:
+                calendar_response = self.__retrieve_url_response(file_data if file_data.get('sha256') is not None else None)
+                if calendar_response.status_code != 304:
+                    span.set(result='miss')
+                    self.__save_body(calendar_response, file_data)
+            except requests.RequestException as e:
+                if file_data.get('sha256') is None:
+                    raise
+                ## Serve the last good copy; last_update is left alone so the next call tries again
+                print('Unable to refresh {:s}, using cached copy: {:s}'.format(self.label, describe_error(e)))
+                span.set(result='stale')
+                return file_data
+            if calendar_response.status_code != 304:
+                file_data['etag'] = calendar_response.headers.get('ETag')
+                file_data['last_modified'] = calendar_response.headers.get('Last-Modified')
+            else:
+                ## Not modified; the server may still have sent fresh validators
+                span.set(result='revalidated')
+                file_data['etag'] = calendar_response.headers.get('ETag', file_data.get('etag'))
+                file_data['last_modified'] = calendar_response.headers.get('Last-Modified', file_data.get('last_modified'))
+            file_data['max_age'] = parse_max_age(calendar_response.headers.get('Cache-Control'))
+            file_data['last_update'] = now.strftime(timeformat)
+            with atomic_write(os.path.join(self.cache_dir, self.cache_file)) as outfil:
+                json.dump(file_data, outfil)
+            return file_data
+
+    ## Refresh the cached copy on another thread, unless one is already at it. The thread isn't a daemon, so a
+    ## one-off run finishes the fetch before exiting and leaves the next run a fresh copy.
+    def __revalidate_in_background(self):
+        with self.revalidating_lock:
+            if self.revalidating:
+                return
+            self.revalidating = True
+        threading.Thread(target=self.__revalidate, name='revalidate {:s}'.format(self.label)).start()
+
+    def __revalidate(self):
+        try:
+            with metrics.span('calendar_cache.revalidate', calendar=self.label) as span:
+                self.__refresh(span, 1-self.refresh_ahead, blocking=False)
+        except Exception as e:
+            print('Unable to refresh {:s} in the background: {:s}'.format(self.label, describe_error(e)))
+        finally:
+            with self.revalidating_lock:
+                self.revalidating = False
+
+    def __load_file_data(self):
+        file_data = {'sha256':None}
         file_path = os.path.join(self.cache_dir, self.cache_file)
         if os.path.isfile(file_path):
             try:
@@ -36,49 +253,486 @@ class CalendarCache(object):
             except:
                 ## If we can't load it, oh well, just re-cache it
                 pass
-        cache_last_update = datetime.datetime.strptime(file_data.get('last_update', '1990-01-01 01:00:00 +0000'), timeformat)
-        if file_data['data'] is None or cache_last_update <= (now - self.cache_expiry):
-            file_data['data'] = self.__retrieve_url_data()
-            file_data['last_update'] = now.strftime(timeformat)
-            with open(file_path, 'w') as outfil:
-                json.dump(file_data, outfil)
-        return file_data['data']
+        ## Keep only what the current format uses; files from before bodies got their own file hold the whole
+        ## body under 'data', which would otherwise be carried along (and loaded) forever
+        file_data = {key: value for key, value in file_data.items() if key in cache_file_keys}
+        ## Only trust the description if the body it describes is still there
+        if file_data.get('sha256') is not None and not os.path.isfile(os.path.join(self.cache_dir, self.body_file)):
+            file_data['sha256'] = None
+        return file_data
+
+    def __get_age(self, file_data):
+        now = datetime.datetime.now(currenttz())
+        return now - datetime.datetime.strptime(file_data.get('last_update', '1990-01-01 01:00:00 +0000'), timeformat)
+
+    ## Stream a response body into the body file a chunk at a time, never holding all of it, noting its
+    ## digest, size and encoding in file_data
+    def __save_body(self, calendar_response, file_data):
+        digest = hashlib.sha256()
+        size = 0
+        with atomic_write(os.path.join(self.cache_dir, self.body_file), 'wb') as outfil:
+            for chunk in calendar_response.iter_content(chunk_size=64*1024):
+                digest.update(chunk)
+                size += len(chunk)
+                outfil.write(chunk)
+        file_data['sha256'] = digest.hexdigest()
+        file_data['bytes'] = size
+        file_data['encoding'] = self.__get_encoding(calendar_response)
 
-    ## Unconditionally retrieve the data from the expected URL
-    def __retrieve_url_data(self):
-        calendar_response = requests.get(self.url)
+    def __read_body(self, encoding):
+        with open(os.path.join(self.cache_dir, self.body_file), 'r', encoding=encoding, errors='replace', newline='') as infil:
+            for line in infil:
+                yield line
+
+    ## iCalendar is UTF-8 unless the server says otherwise; requests would otherwise assume ISO-8859-1 for any text/ type
+    def __get_encoding(self, calendar_response):
+        if 'charset' in calendar_response.headers.get('Content-Type', '').lower() and calendar_response.encoding is not None:
+            return calendar_response.encoding
+        return 'utf-8'
+
+    def __get_text(self, calendar_response):
+        calendar_response.encoding = self.__get_encoding(calendar_response)
+        return calendar_response.text
+
+    ## How long the cached copy is good for; the server's max-age if it gave one, otherwise cache_expiry
+    def __get_expiry(self, file_data):
+        if file_data.get('max_age') is None:
+            return self.cache_expiry
+        return max(datetime.timedelta(seconds=file_data['max_age']), self.minimum_cache_expiry)
+
+    ## Retrieve the data from the expected URL; when given the cached file data, ask only for changes
+    ## since then, in which case a 304 response means the cached data is still current. The body
+    ## is left unread, to be streamed by the caller.
+    def __retrieve_url_response(self, file_data=None):
+        headers = {}
+        if file_data is not None:
+            if file_data.get('etag') is not None:
+                headers['If-None-Match'] = file_data['etag']
+            if file_data.get('last_modified') is not None:
+                headers['If-Modified-Since'] = file_data['last_modified']
+        with metrics.span('calendar_cache.http', calendar=self.label) as span:
+            calendar_response = get_http_session().get(self.url, headers=headers, timeout=self.timeout, stream=True)
+            span.set(status=calendar_response.status_code)
+        ## Only a 200 has a body worth streaming; anything else (empty for a 304) is read straight away, as a streamed
+        ## response only hands its connection back to the session's pool once its body has been read
         if calendar_response.status_code != 200:
+            calendar_response.content
+        if calendar_response.status_code != 200 and calendar_response.status_code != 304:
             calendar_response.raise_for_status()
-        return calendar_response.text
+        return calendar_response
+
+## Whether something running from startKey to endKey happens within [windowStart, windowEnd); either end of
+## the window may be None for unbounded. Something ending exactly as the window opens doesn't count, but a
+## zero-length event at that instant still does.
+def overlapsWindow(startKey, endKey, windowStart, windowEnd):
+    if windowEnd is not None and startKey >= windowEnd:
+        return False
+    if windowStart is None:
+        return True
+    return endKey > windowStart or (endKey == startKey and startKey >= windowStart)
+
+## The raw start and end of a VEVENT; with no DTEND the end comes from DURATION, or failing that
+## is the start itself (a day later for an all-day event)
+def get_component_times(component):
+    start = component.get('DTSTART').dt
+    if component.get('DTEND') is not None:
+        return start, component.get('DTEND').dt
+    if component.get('DURATION') is not None:
+        return start, start + component.get('DURATION').dt
+    if type(start) is datetime.date:
+        return start, start + datetime.timedelta(days=1)
+    return start, start
+
+## Bump whenever parsing changes what events come out of a feed, so cached results from older code aren't reused
+parsed_events_version = 4
+
+## Recurring series with no end are only expanded this far past the start of an unbounded window
+recurrence_horizon = datetime.timedelta(days=366)
+
+## Every value of a (possibly repeated) list property such as EXDATE or RDATE; periods give their start
+def get_component_dates(component, name):
+    props = component.get(name)
+    if props is None:
+        return []
+    if not isinstance(props, list):
+        props = [props]
+    values = []
+    for prop in props:
+        for value in prop.dts:
+            values.append(value.dt[0] if isinstance(value.dt, tuple) else value.dt)
+    return values
+
+## Rebase a start time onto a tzinfo that dateutil can step through wall-clock time with, returning it along with
+## the zone any naive occurrences are wall-clock times in. pytz zones pin the offset of the instant they were
+## localized for, so a weekly 9am would drift an hour across a DST change; the equivalent zoneinfo zone works out
+## the offset for every occurrence. A zone only defined by the feed's own VTIMEZONE has no zoneinfo equivalent, so
+## the series is expanded as naive wall-clock times and each occurrence localized in the zone afterwards. Dates and
+## floating times are expanded as naive datetimes with no zone.
+def get_recurrence_start(start):
+    if type(start) is datetime.date:
+        return datetime.datetime(start.year, start.month, start.day), None
+    zone = getattr(start.tzinfo, 'zone', None)
+    if zone is not None:
+        try:
+            return start.replace(tzinfo=zoneinfo.ZoneInfo(zone)), None
+        except (ValueError, zoneinfo.ZoneInfoNotFoundError):
+            pass
+    if hasattr(start.tzinfo, 'localize'):
+        return start.replace(tzinfo=None), start.tzinfo
+    return start, None
+
+## Bring an EXDATE/RDATE/UNTIL/window bound into the same form (naive or aware) as the series start; naive
+## starts are wall-clock times in wallClockZone (local if None)
+def match_recurrence_start(value, recurrenceStart, wallClockZone=None):
+    if type(value) is datetime.date:
+        value = datetime.datetime.combine(value, recurrenceStart.time())
+    if recurrenceStart.tzinfo is None:
+        if value.tzinfo is not None:
+            value = value.astimezone(wallClockZone).replace(tzinfo=None)
+        return value
+    if value.tzinfo is None:
+        return value.replace(tzinfo=recurrenceStart.tzinfo)
+    return value.astimezone(recurrenceStart.tzinfo)
+
+## The (start, end) of each occurrence of a recurring VEVENT that lands in the window, expanding its
+## RRULE/RDATE/EXDATE only as far as the window needs. skipKeys holds the comparable RECURRENCE-IDs of
+## occurrences that have their own override VEVENT, so they aren't drawn twice.
+def expand_recurrences(component, windowStartKey, windowEndKey, skipKeys):
+    import dateutil.rrule
+    start, end = get_component_times(component)
+    duration = end - start
+    recurrenceStart, wallClockZone = get_recurrence_start(start)
+    ruleset = dateutil.rrule.rruleset()
+    rules = component.get('RRULE')
+    if rules is None:
+        rules = []
+    elif not isinstance(rules, list):
+        rules = [rules]
+    for rule in rules:
+        ## dateutil insists UNTIL is in UTC exactly when DTSTART has a zone, which feeds often ignore (a date, or a
+        ## floating time, for a series with a TZID), so UNTIL is converted to match the start here instead
+        rule = rule.copy()
+        until = rule.pop('UNTIL', None)
+        rrule = dateutil.rrule.rrulestr(rule.to_ical().decode(), dtstart=recurrenceStart)
+        if until:
+            rrule = rrule.replace(until=match_recurrence_start(until[0], recurrenceStart, wallClockZone))
+        ruleset.rrule(rrule)
+    ## DTSTART is always an occurrence, whether or not it matches the rule
+    ruleset.rdate(recurrenceStart)
+    for rdate in get_component_dates(component, 'RDATE'):
+        ruleset.rdate(match_recurrence_start(rdate, recurrenceStart, wallClockZone))
+    for exdate in get_component_dates(component, 'EXDATE'):
+        ruleset.exdate(match_recurrence_start(exdate, recurrenceStart, wallClockZone))
+    # Pad a day either side so wall-clock vs local differences can't lose an occurrence; overlapsWindow trims exactly
+    if windowStartKey is None:
+        after = recurrenceStart
+    else:
+        after = match_recurrence_start(windowStartKey, recurrenceStart, wallClockZone) - duration - datetime.timedelta(days=1)
+    if windowEndKey is None:
+        before = max(after, recurrenceStart) + recurrence_horizon
+    else:
+        before = match_recurrence_start(windowEndKey, recurrenceStart, wallClockZone) + datetime.timedelta(days=1)
+    occurrences = []
+    for occurrence in ruleset.between(after, before, inc=True):
+        if type(start) is datetime.date:
+            occurrenceStart = occurrence.date()
+        elif wallClockZone is not None:
+            occurrenceStart = wallClockZone.normalize(wallClockZone.localize(occurrence))
+        else:
+            occurrenceStart = occurrence
+        occurrenceEnd = occurrenceStart + duration
+        startKey = toComparable(occurrenceStart)
+        if startKey in skipKeys:
+            continue
+        if overlapsWindow(startKey, toComparable(occurrenceEnd), windowStartKey, windowEndKey):
+            occurrences.append((occurrenceStart, occurrenceEnd))
+    return occurrences
+
+## A digest of everything about a set of events that ends up on screen, plus any extra strings (the date, say);
+## if two renders have the same digest they draw the same frame
+def get_events_digest(events, *extra):
+    digest = hashlib.sha256()
+    for value in extra:
+        digest.update(value.encode())
+        digest.update(b'\0')
+    for event in sorted(events, key=lambda event: (event.getStartKey(), event.getEndKey(), event.getSummary() or '')):
+        digest.update('{}\0{:s}\0{:s}\0'.format(event.getSummary(), event.getStartKey().isoformat(), event.getEndKey().isoformat()).encode())
+    return digest.hexdigest()
+
+## Join folded lines back up (a line starting with a space or tab continues the one before it), dropping line endings
+def unfold_lines(lines):
+    current = None
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line[:1] in (' ', '\t') and current is not None:
+            current.append(line[1:])
+            continue
+        if current is not None:
+            yield ''.join(current)
+        current = [line] if line else None
+    if current is not None:
+        yield ''.join(current)
+
+## Each component directly inside the VCALENDAR, as (name, its unfolded lines), one at a time; only the
+## component being read is ever held, never the whole calendar
+def iter_components(lines):
+    depth = 0
+    name = None
+    component = None
+    for line in unfold_lines(lines):
+        keyword = line[:6].upper()
+        if keyword == 'BEGIN:':
+            depth += 1
+            if depth == 2:
+                name = line[6:].strip().upper()
+                component = []
+        if component is not None:
+            component.append(line)
+        if keyword[:4] == 'END:':
+            if depth == 2 and component is not None:
+                yield name, component
+                component = None
+            depth -= 1
+
+## The raw text of a VEVENT's own properties (not those of its VALARMs), as {name: value}
+def get_raw_properties(component):
+    properties = {}
+    depth = 0
+    for line in component:
+        keyword = line[:6].upper()
+        if keyword == 'BEGIN:':
+            depth += 1
+        elif keyword[:4] == 'END:':
+            depth -= 1
+        elif depth == 1:
+            match = re.match(r'([A-Za-z0-9-]+)[;:]', line)
+            if match is not None:
+                properties.setdefault(match.group(1).upper(), line.rpartition(':')[2])
+    return properties
+
+## Timezones can put an event's local date up to two days either side of ours, so the text check allows that much
+raw_window_slack = datetime.timedelta(days=2)
+
+## A quick look at a VEVENT's text for whether it could possibly be in the window, so the events that
+## plainly aren't (most of a big feed) are never handed to icalendar. Anything that recurs, or whose
+## times don't look like plain dates, is let through to be checked properly.
+def might_overlap_window(component, windowStartDate, windowEndDate):
+    properties = get_raw_properties(component)
+    if 'DTSTART' not in properties:
+        return False
+    if 'RRULE' in properties or 'RDATE' in properties or 'RECURRENCE-ID' in properties:
+        return True
+    try:
+        start = datetime.datetime.strptime(properties['DTSTART'][:8], '%Y%m%d').date()
+        if 'DTEND' in properties:
+            end = datetime.datetime.strptime(properties['DTEND'][:8], '%Y%m%d').date()
+        elif 'DURATION' in properties:
+            return True
+        else:
+            end = start
+    except ValueError:
+        return True
+    if windowEndDate is not None and start > windowEndDate + raw_window_slack:
+        return False
+    if windowStartDate is not None and end < windowStartDate - raw_window_slack:
+        return False
+    return True
+
+## Read the calendar a component at a time, throwing away anything plainly outside the window on its
+## raw text, and anything else outside it on its parsed DTSTART/DTEND, before an ICalendarEvent is ever
+## built for it. Recurring events are expanded only within the window; ICalendarCacheWrapper caches the
+## result by feed hash and window. lines is any iterable of the calendar's lines (an open file, say),
+## or the whole text as one string.
+def parse_events(lines, windowStart, windowEnd):
+    import icalendar
+    if isinstance(lines, str):
+        lines = io.StringIO(lines)
+    windowStartKey = None if windowStart is None else toComparable(windowStart)
+    windowEndKey = None if windowEnd is None else toComparable(windowEnd)
+    windowStartDate = None if windowStartKey is None else windowStartKey.date()
+    windowEndDate = None if windowEndKey is None else windowEndKey.date()
+    candidates = []
+    for name, component in iter_components(lines):
+        if name == 'VTIMEZONE':
+            ## Parsing it is enough for icalendar to know the zone when events refer to it
+            icalendar.Timezone.from_ical('\r\n'.join(component))
+        elif name == 'VEVENT' and might_overlap_window(component, windowStartDate, windowEndDate):
+            candidates.append('\r\n'.join(component))
+    ## Events are only parsed once every timezone has been seen, as a feed may define them last
+    events = []
+    recurring = []
+    overridden = {}
+    for candidate in candidates:
+        component = icalendar.Event.from_ical(candidate)
+        if component.get('DTSTART') is None:
+            continue
+        if component.get('RRULE') is not None or component.get('RDATE') is not None:
+            ## Held back until every override has been seen
+            recurring.append(component)
+            continue
+        if component.get('RECURRENCE-ID') is not None:
+            overridden.setdefault(str(component.get('UID')), set()).add(toComparable(component.get('RECURRENCE-ID').dt))
+        start, end = get_component_times(component)
+        if overlapsWindow(toComparable(start), toComparable(end), windowStartKey, windowEndKey):
+            events.append(ICalendarEvent(component))
+    for component in recurring:
+        skipKeys = overridden.get(str(component.get('UID')), set())
+        try:
+            occurrences = expand_recurrences(component, windowStartKey, windowEndKey, skipKeys)
+        except ValueError as e:
+            ## A rule we can't understand shouldn't cost us the rest of the calendar; show its first occurrence only
+            print('Unable to expand recurrence of {}: {}'.format(component.get('SUMMARY'), e))
+            start, end = get_component_times(component)
+            occurrences = [(start, end)] if overlapsWindow(toComparable(start), toComparable(end), windowStartKey, windowEndKey) else []
+        for occurrence in occurrences:
+            events.append(ICalendarEvent(component, occurrence=occurrence))
+    return events
+
+## Fetch and parse every source at the same time, so a refresh waits for the slowest calendar rather than all of them
+## in turn. A source that fails, or hasn't finished within timeout seconds, contributes its last good events instead.
+def get_all_events_between(sources, windowStart, windowEnd, timeout=None):
+    sources = list(sources)
+    if timeout is None:
+        timeout = 60
+    if len(sources) == 0:
+        return []
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(sources))
+    try:
+        futures = [executor.submit(source.get_events_between, windowStart, windowEnd) for source in sources]
+        concurrent.futures.wait(futures, timeout=timeout)
+        events = []
+        for source, future in zip(sources, futures):
+            if not future.done():
+                print('Timed out loading {:s}, using last good copy'.format(source.get_label()))
+                events += source.get_stale_events_between(windowStart, windowEnd)
+            elif future.exception() is not None:
+                print('Unable to load {:s}, using last good copy: {:s}'.format(source.get_label(), describe_error(future.exception())))
+                events += source.get_stale_events_between(windowStart, windowEnd)
+            else:
+                events += future.result()
+        return events
+    finally:
+        ## Don't wait on stragglers; their own request timeout lets them finish in the background
+        executor.shutdown(wait=False)
 
 class ICalendarCacheWrapper(object):
-    def __init__(self, url, cache_dir=None, cache_expiry=None):
-        self.calendar_cache = CalendarCache(url, cache_dir=cache_dir, cache_expiry=cache_expiry)
+    def __init__(self, url, cache_dir=None, cache_expiry=None, timeout=None):
+        self.calendar_cache = CalendarCache(url, cache_dir=cache_dir, cache_expiry=cache_expiry, timeout=timeout)
+        self.cache_dir = cache_dir
+        self.events_file = '{}.events.json'.format(hashlib.sha256(url.encode()).hexdigest())
+        self.parsed_key = None
+        self.parsed_events = None
+
+    def get_url(self):
+        return self.calendar_cache.url
+
+    ## What to call the calendar in logs and metrics, as its URL may carry an access token
+    def get_label(self):
+        return self.calendar_cache.label
 
     def get_events(self):
-        calendar = icalendar.Calendar.from_ical(self.calendar_cache.get())
-        return [ICalendarEvent(event) for event in calendar.walk('VEVENT')]
+        return self.get_events_between(None, None)
 
     def get_events_after(self, dateOrDatetime):
-        calendar = icalendar.Calendar.from_ical(self.calendar_cache.get())
-        events = []
-        for event in calendar.walk('VEVENT'):
-            ievent = ICalendarEvent(event)
-            relevant = ( ievent.getStart().isoformat() >= dateOrDatetime.isoformat()
-                         or ievent.getEnd().isoformat() >= dateOrDatetime.isoformat() )
-            if relevant:
-                events.append(ievent)
+        return self.get_events_between(dateOrDatetime, None)
+
+    ## Events overlapping [windowStart, windowEnd); either bound may be None for unbounded
+    def get_events_between(self, windowStart, windowEnd):
+        return list(self.__get_parsed_events(windowStart, windowEnd))
+
+    ## The last successfully parsed events, without touching the network; used when a fetch fails or is too slow.
+    ## These may have been parsed for a different window, so they're only trimmed to this one, never extended.
+    def get_stale_events_between(self, windowStart, windowEnd):
+        events = self.parsed_events
+        if events is None:
+            events = self.__load_parsed_events(None)
+        if events is None:
+            return []
+        windowStartKey = None if windowStart is None else toComparable(windowStart)
+        windowEndKey = None if windowEnd is None else toComparable(windowEnd)
+        return [event for event in events if overlapsWindow(event.getStartKey(), event.getEndKey(), windowStartKey, windowEndKey)]
+
+    ## Parsing the ICS text is the slowest part of loading a calendar, so the parsed events are kept
+    ## (in memory and, with a cache_dir, on disk) keyed by the SHA-256 of the text they came from and the
+    ## window asked for; an unchanged feed is never handed to icalendar again until the window moves
+    def __get_parsed_events(self, windowStart, windowEnd):
+        digest, lines = self.calendar_cache.get_lines()
+        parsed_key = [parsed_events_version, digest,
+                      None if windowStart is None else windowStart.isoformat(),
+                      None if windowEnd is None else windowEnd.isoformat()]
+        ## Without a cache_dir there's no digest to tell whether the feed changed, so it's always parsed
+        if digest is not None and parsed_key == self.parsed_key:
+            return self.parsed_events
+        with metrics.span('calendar.parse', calendar=self.calendar_cache.label) as span:
+            events = self.__load_parsed_events(parsed_key)
+            span.set(cached=events is not None)
+            if events is None:
+                events = parse_events(lines, windowStart, windowEnd)
+                self.__save_parsed_events(parsed_key, events)
+            span.set(events=len(events))
+        self.parsed_key = parsed_key
+        self.parsed_events = events
         return events
 
+    ## A parsed_key of None accepts whatever was last parsed
+    def __load_parsed_events(self, parsed_key):
+        if self.cache_dir is None:
+            return None
+        file_path = os.path.join(self.cache_dir, self.events_file)
+        if not os.path.isfile(file_path):
+            return None
+        try:
+            with open(file_path, 'r') as infil:
+                file_data = json.load(infil)
+            if parsed_key is not None and file_data.get('key') != parsed_key:
+                return None
+            return [ICalendarEvent.fromRecord(record) for record in file_data['events']]
+        except:
+            ## If we can't load it, oh well, just parse it again
+            return None
+
+    def __save_parsed_events(self, parsed_key, events):
+        if self.cache_dir is None:
+            return
+        file_data = {'key':parsed_key, 'events':[event.toRecord() for event in events]}
+        with atomic_write(os.path.join(self.cache_dir, self.events_file)) as outfil:
+            json.dump(file_data, outfil)
+
 class ICalendarEvent(object):
-    def __init__(self, event, tzinfo=None):
+    ## A big feed can leave thousands of these alive at once, so they carry no __dict__
+    __slots__ = ('summary', 'start', 'end', 'startKey', 'endKey')
+
+    ## occurrence, a (start, end) pair, stands in for the event's own times when it's one instance of a series
+    def __init__(self, event, tzinfo=None, occurrence=None):
         self.summary = event.get('SUMMARY')
-        self.start = event.get('DTSTART').dt
-        self.end = event.get('DTEND').dt
+        if self.summary is not None:
+            self.summary = str(self.summary)
+        if occurrence is None:
+            occurrence = get_component_times(event)
+        self.start, self.end = occurrence
         if type(self.start) is datetime.datetime:
             self.start = self.start.astimezone(tzinfo)
         if type(self.end) is datetime.datetime:
             self.end = self.end.astimezone(tzinfo)
+        self.__normalize()
+
+    ## Work out the comparable start and end once, rather than on every comparison
+    def __normalize(self):
+        self.startKey = toComparable(self.start)
+        self.endKey = toComparable(self.end)
+
+    ## Compact form for the parsed-event cache: [summary, start, end, all-day]
+    def toRecord(self):
+        return [self.summary, self.start.isoformat(), self.end.isoformat(), self.isAllDay()]
+
+    @classmethod
+    def fromRecord(cls, record):
+        ievent = cls.__new__(cls)
+        ievent.summary = record[0]
+        ievent.start = parseIsoDateOrDatetime(record[1])
+        ievent.end = parseIsoDateOrDatetime(record[2])
+        ievent.__normalize()
+        return ievent
 
     def getSummary(self):
         return self.summary
@@ -86,14 +740,29 @@ class ICalendarEvent(object):
         return self.start
     def getEnd(self):
         return self.end
+    def getStartKey(self):
+        return self.startKey
+    def getEndKey(self):
+        return self.endKey
     def isAllDay(self):
         return type(self.start) is datetime.date and type(self.end) is datetime.date
     def occursOn(self, date):
-        dateIso = date.isoformat()
-        nextDateIso = (date + datetime.timedelta(days=1)).isoformat()
-        startIso = self.start.isoformat()
-        endIso = self.end.isoformat()
-        return ((startIso <= dateIso and endIso > dateIso) 
-                or (startIso >= dateIso and startIso < nextDateIso)
-                or (endIso >= dateIso and endIso < nextDateIso)
-                and not endIso == dateIso)
+        return overlapsWindow(self.startKey, self.endKey, toComparable(date), toComparable(date + datetime.timedelta(days=1)))
+
+## Maps each date from firstDate to lastDate (inclusive) to the events on it, in start order.
+## Built once per render so drawing a date is a lookup instead of a scan of every event.
+class EventIndex(object):
+    def __init__(self, events, firstDate, lastDate):
+        events = sorted(events, key=lambda event: (event.getStartKey(), event.getEndKey()))
+        starts = [event.getStartKey() for event in events]
+        # Nothing starting after the range can occur in it
+        lastEvent = bisect.bisect_left(starts, toComparable(lastDate + datetime.timedelta(days=1)))
+        self.days = {}
+        for event in events[:lastEvent]:
+            day = max(firstDate, event.getStartKey().astimezone().date())
+            while day <= lastDate and event.occursOn(day):
+                self.days.setdefault(day, []).append(event)
+                day += datetime.timedelta(days=1)
+
+    def eventsOn(self, date):
+        return self.days.get(date, [])
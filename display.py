@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+import json, hashlib, os, calendar_loader, metrics
+## PIL is imported where frames are diffed or read back from disk, so a run that finds nothing has changed never loads it
+
+## What the refresh planner needs from a panel. Anything with these methods will do, which is what
+## lets the planner be exercised against a mock instead of real hardware.
+class DisplayBackend(object):
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+
+    def supportsPartial(self):
+        return False
+    ## Clear and redraw the whole panel
+    def displayFull(self, image):
+        raise NotImplementedError()
+    ## Redraw only the given regions ([x0, y0, x1, y1], x0 and x1 multiples of 8) from image
+    def displayPartial(self, image, regions):
+        raise NotImplementedError()
+
+## The panel's size is given up front and its driver only made (by calling createEpd) when something is first
+## sent to it, as importing the driver brings up the SPI and GPIO bindings, which a run that skips never needs
+class WaveshareBackend(DisplayBackend):
+    def __init__(self, width, height, createEpd):
+        super().__init__(width, height)
+        self.createEpd = createEpd
+        self.epd = None
+
+    def getEpd(self):
+        if self.epd is None:
+            with metrics.span('epd.load'):
+                self.epd = self.createEpd()
+        return self.epd
+
+    ## Older drivers for the panel have no partial update
+    def supportsPartial(self):
+        epd = self.getEpd()
+        return hasattr(epd, 'init_part') and hasattr(epd, 'display_Partial')
+
+    def displayFull(self, image):
+        epd = self.getEpd()
+        try:
+            with metrics.span('epd.init'):
+                epd.init()
+            with metrics.span('epd.clear'):
+                epd.Clear()
+            with metrics.span('epd.display'):
+                epd.display(epd.getbuffer(image))
+        finally:
+            with metrics.span('epd.sleep'):
+                epd.sleep()
+
+    def displayPartial(self, image, regions):
+        epd = self.getEpd()
+        try:
+            with metrics.span('epd.init_part'):
+                epd.init_part()
+            for region in regions:
+                with metrics.span('epd.display_partial', pixels=(region[2]-region[0])*(region[3]-region[1])):
+                    epd.display_Partial(self.getRegionBuffer(image, region), region[0], region[1], region[2], region[3])
+        finally:
+            with metrics.span('epd.sleep'):
+                epd.sleep()
+
+    ## Pack a region the same way epd.getbuffer packs the whole frame; one bit per pixel, rows
+    ## left to right, inverted, which is why region x bounds have to fall on byte boundaries
+    def getRegionBuffer(self, image, region):
+        buf = bytearray(image.crop(region).convert('1').tobytes('raw'))
+        for i in range(len(buf)):
+            buf[i] ^= 0xFF
+        return buf
+
+def frameDigest(image):
+    return hashlib.sha256(image.tobytes()).hexdigest()
+
+## Writes each frame to a PNG file, for running and profiling the renderer without a panel
+class PngFileBackend(DisplayBackend):
+    def __init__(self, width, height, path):
+        super().__init__(width, height)
+        self.path = path
+
+    def displayFull(self, image):
+        image.save(self.path)
+
+## Keeps what would be on the panel in memory, recording every call; partial updates are pasted into the
+## current frame region by region, so the result shows what a partial refresh would actually leave on screen
+class MemoryBackend(DisplayBackend):
+    def __init__(self, width, height):
+        super().__init__(width, height)
+        self.frame = None
+        self.calls = []
+
+    def supportsPartial(self):
+        return True
+
+    def displayFull(self, image):
+        self.frame = image.copy()
+        self.calls.append(('full', None))
+
+    def displayPartial(self, image, regions):
+        for region in regions:
+            self.frame.paste(image.crop(region), region[:2])
+        self.calls.append(('partial', regions))
+
+## Decides how to get a new frame onto the panel. The new frame is compared with the last one shown,
+## band by band, to find the rectangles that changed; small changes go out as partial updates, while
+## large ones, or every full_refresh_every partials (to clear the ghosting partials leave behind), get a
+## full refresh. A frame identical to the one already shown (by hash) isn't sent at all. With a state_dir the
+## last frame and its hash survive between runs, so one-shot runs get partial refreshes and skips too.
+class RefreshPlanner(object):
+    def __init__(self, backend, state_dir=None, full_refresh_every=None, max_partial_fraction=None, band_height=None):
+        self.backend = backend
+        self.state_dir = state_dir
+        if full_refresh_every is None:
+            full_refresh_every = 10
+        self.full_refresh_every = full_refresh_every
+        if max_partial_fraction is None:
+            max_partial_fraction = 0.25
+        self.max_partial_fraction = max_partial_fraction
+        if band_height is None:
+            band_height = 16
+        self.band_height = band_height
+        self.last_image = None
+        ## The last frame is only read back from state_dir when a new frame needs diffing against it
+        self.last_image_loaded = state_dir is None
+        self.last_digest = None
+        self.last_inputs_digest = None
+        self.partials_since_full = 0
+        self.__load_state()
+
+    ## Whether the frame on the panel was drawn from inputs with this digest, in which case there's no need to draw it again
+    def isShowing(self, inputs_digest):
+        return inputs_digest is not None and inputs_digest == self.last_inputs_digest
+
+    ## Show image, returning which kind of refresh was used: 'full', 'partial' or 'none'. inputs_digest
+    ## identifies what the frame was drawn from, for isShowing.
+    def present(self, image, force_full=False, inputs_digest=None):
+        image = image.convert('1')
+        with metrics.span('refresh.plan') as span:
+            mode, regions = self.plan(image, force_full=force_full)
+            span.set(mode=mode)
+        if mode == 'none':
+            if inputs_digest != self.last_inputs_digest:
+                self.last_inputs_digest = inputs_digest
+                self.__save_state()
+            return mode
+        if mode == 'full':
+            self.backend.displayFull(image)
+            self.partials_since_full = 0
+        else:
+            self.backend.displayPartial(image, regions)
+            self.partials_since_full += 1
+        self.last_image = image
+        self.last_image_loaded = True
+        self.last_digest = frameDigest(image)
+        self.last_inputs_digest = inputs_digest
+        self.__save_state()
+        return mode
+
+    ## The kind of refresh image needs, and the regions to update if it's a partial one
+    def plan(self, image, force_full=False):
+        if force_full:
+            return 'full', None
+        ## Cheaper than a diff, and works even if the last frame image itself was lost
+        if self.last_digest is not None and self.last_digest == frameDigest(image):
+            return 'none', []
+        self.__load_last_image()
+        if self.last_image is None or self.last_image.size != image.size:
+            return 'full', None
+        regions = self.findDirtyRegions(image)
+        if len(regions) == 0:
+            return 'none', regions
+        if not self.backend.supportsPartial() or self.partials_since_full >= self.full_refresh_every:
+            return 'full', None
+        dirtyArea = sum((region[2]-region[0])*(region[3]-region[1]) for region in regions)
+        if dirtyArea > self.max_partial_fraction*image.size[0]*image.size[1]:
+            return 'full', None
+        return 'partial', regions
+
+    ## Rectangles covering every pixel that differs from the last frame. Each band of rows gets its own
+    ## bounding box, and boxes in consecutive bands that overlap horizontally are merged, so two small changes
+    ## far apart (the time line and today's cell) stay two small regions rather than one large one.
+    def findDirtyRegions(self, image):
+        from PIL import ImageChops
+        self.__load_last_image()
+        if self.last_image is None:
+            return [[0, 0, image.size[0], image.size[1]]]
+        diff = ImageChops.logical_xor(self.last_image, image)
+        regions = []
+        openRegion = None
+        for bandTop in range(0, image.size[1], self.band_height):
+            bbox = diff.crop((0, bandTop, image.size[0], min(bandTop+self.band_height, image.size[1]))).getbbox()
+            if bbox is None:
+                box = None
+            else:
+                # Byte-align horizontally, as the panel addresses 8 pixels at a time
+                box = [bbox[0]//8*8, bandTop+bbox[1], min((bbox[2]+7)//8*8, image.size[0]), bandTop+bbox[3]]
+            if openRegion is not None and box is not None and openRegion[0] < box[2] and box[0] < openRegion[2]:
+                box = [min(openRegion[0], box[0]), openRegion[1], max(openRegion[2], box[2]), box[3]]
+            elif openRegion is not None:
+                regions.append(openRegion)
+            openRegion = box
+        if openRegion is not None:
+            regions.append(openRegion)
+        return regions
+
+    def __load_state(self):
+        if self.state_dir is None:
+            return
+        try:
+            with open(os.path.join(self.state_dir, 'display_state.json'), 'r') as infil:
+                state = json.load(infil)
+            self.partials_since_full = state.get('partials_since_full', 0)
+            self.last_digest = state.get('frame_sha256')
+            self.last_inputs_digest = state.get('inputs_sha256')
+        except:
+            ## If we can't load it, oh well, the next refresh is a full one
+            self.last_digest = None
+            self.last_inputs_digest = None
+            self.partials_since_full = 0
+
+    def __load_last_image(self):
+        if self.last_image_loaded:
+            return
+        self.last_image_loaded = True
+        from PIL import Image
+        try:
+            with Image.open(os.path.join(self.state_dir, 'last_frame.png')) as last_frame:
+                self.last_image = last_frame.convert('1')
+        except:
+            ## Without it there's nothing to diff against, but the digests still tell an unchanged frame
+            self.last_image = None
+
+    ## Both files are replaced atomically, so a power cut mid-save can't leave a truncated one to force a full refresh
+    def __save_state(self):
+        if self.state_dir is None:
+            return
+        os.makedirs(self.state_dir, exist_ok=True)
+        if self.last_image is not None:
+            with calendar_loader.atomic_write(os.path.join(self.state_dir, 'last_frame.png'), 'wb') as outfil:
+                self.last_image.save(outfil, format='PNG')
+        with calendar_loader.atomic_write(os.path.join(self.state_dir, 'display_state.json')) as outfil:
+            json.dump({'partials_since_full':self.partials_since_full, 'frame_sha256':self.last_digest,
+                       'inputs_sha256':self.last_inputs_digest}, outfil)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+import collections, json, os
+## PIL is imported where fonts are loaded, which a run that skips drawing never gets to
+
+def boundsToSize(bounds):
+    return [(bounds[2]-bounds[0]), (bounds[3]-bounds[1])]
+def bbFitWithin(fittingBB, fitIntoBB):
+    fittingSize = boundsToSize(fittingBB)
+    fitIntoSize = boundsToSize(fitIntoBB)
+    return fittingSize[0] <= fitIntoSize[0] and fittingSize[1] <= fitIntoSize[1]
+## Width of text as drawn on a 1-bit image, the same as ImageDraw.textlength gives for one
+def measureText(imageFont, text):
+    return imageFont.getlength(text, mode='1')
+
+## Loads fonts, works out how big a font can be drawn in a box and how much of a string fits in a width,
+## remembering all three. Loaded fonts and fitted strings are kept in LRUs; solved sizes are kept in a JSON
+## file (cache_file) keyed by the font path, its modification time, the box size and the test string, so they
+## survive restarts. Font here is the path to the font, not a font object
+class FontCache(object):
+    def __init__(self, cache_file=None, max_fonts=None, max_fitted_texts=None):
+        self.cache_file = cache_file
+        if max_fonts is None:
+            max_fonts = 32
+        self.max_fonts = max_fonts
+        if max_fitted_texts is None:
+            max_fitted_texts = 1024
+        self.max_fitted_texts = max_fitted_texts
+        self.fonts = collections.OrderedDict()
+        self.fitted_texts = collections.OrderedDict()
+        self.glyph_advances = {}
+        self.font_mtimes = {}
+        self.sizes = {}
+        self.sizes_changed = False
+        if self.cache_file is not None and os.path.isfile(self.cache_file):
+            try:
+                with open(self.cache_file, 'r') as infil:
+                    self.sizes = json.load(infil)
+            except:
+                ## If we can't load it, oh well, the sizes will be solved again
+                self.sizes = {}
+
+    def getFont(self, font, size):
+        key = (font, size)
+        if key in self.fonts:
+            self.fonts.move_to_end(key)
+            return self.fonts[key]
+        from PIL import ImageFont
+        loaded = ImageFont.truetype(font, size)
+        self.fonts[key] = loaded
+        if len(self.fonts) > self.max_fonts:
+            self.fonts.popitem(last=False)
+        return loaded
+
+    def getMaximumFont(self, font, maxSize, testStr):
+        return self.getFont(font, self.getMaximumFontSize(font, maxSize, testStr))
+
+    def getMaximumFontSize(self, font, maxSize, testStr):
+        if font not in self.font_mtimes:
+            self.font_mtimes[font] = os.path.getmtime(font)
+        key = json.dumps([font, self.font_mtimes[font], maxSize[0], maxSize[1], testStr])
+        if key not in self.sizes:
+            self.sizes[key] = self.__solveMaximumFontSize(font, maxSize, testStr)
+            self.sizes_changed = True
+        return self.sizes[key]
+
+    ## The longest start of text that fits in widthToFit pixels when drawn in imageFont (a font from getFont)
+    def getFittedText(self, imageFont, text, widthToFit):
+        key = (imageFont.path, imageFont.size, text, widthToFit)
+        if key in self.fitted_texts:
+            self.fitted_texts.move_to_end(key)
+            return self.fitted_texts[key]
+        if widthToFit < 0:
+            raise Exception('Can\'t fit text {:s}'.format(text))
+        advances = self.__getGlyphAdvances(imageFont)
+        if advances is not None:
+            ## Fixed width, so the width of each start of text is just a sum of its glyphs' advances
+            fitLength = 0
+            width = 0
+            for char in text:
+                if char not in advances:
+                    advances[char] = measureText(imageFont, char)
+                width += advances[char]
+                if width > widthToFit:
+                    break
+                fitLength += 1
+        else:
+            ## Bisect on the cut point; fitLength always fits and missLength never does
+            fitLength = 0
+            missLength = len(text)+1
+            while missLength - fitLength > 1:
+                testLength = (fitLength + missLength) // 2
+                if measureText(imageFont, text[:testLength]) <= widthToFit:
+                    fitLength = testLength
+                else:
+                    missLength = testLength
+        fitted = text[:fitLength]
+        self.fitted_texts[key] = fitted
+        if len(self.fitted_texts) > self.max_fitted_texts:
+            self.fitted_texts.popitem(last=False)
+        return fitted
+
+    ## Advance widths of the glyphs of a fixed width font, filled in as they're needed, or None if the font
+    ## isn't fixed width (or kerns), in which case a string's width isn't the sum of its glyphs' advances
+    def __getGlyphAdvances(self, imageFont):
+        fontKey = (imageFont.path, imageFont.size)
+        if fontKey not in self.glyph_advances:
+            advances = {char: measureText(imageFont, char) for char in 'iW0 '}
+            fixedWidth = (len(set(advances.values())) == 1
+                          and measureText(imageFont, 'iW0 ') == sum(advances.values()))
+            self.glyph_advances[fontKey] = advances if fixedWidth else None
+        return self.glyph_advances[fontKey]
+
+    ## Write out any newly solved sizes
+    def save(self):
+        if self.cache_file is None or not self.sizes_changed:
+            return
+        with open(self.cache_file, 'w') as outfil:
+            json.dump(self.sizes, outfil)
+        self.sizes_changed = False
+
+    ## Grow the size exponentially until it stops fitting, then bisect between the last fit and the first miss
+    def __solveMaximumFontSize(self, font, maxSize, testStr):
+        from PIL import ImageFont
+        fitBB = [0, 0, maxSize[0], maxSize[1]]
+        def fits(testSize):
+            return bbFitWithin(ImageFont.truetype(font, testSize).getbbox(testStr, anchor='lb'), fitBB)
+        if not fits(1):
+            # If even 1 won't fit, we can't print into this space
+            raise Exception('Can\'t fit font {font:s} into bounding box {bb}'.format(font=font, bb=maxSize))
+        fitSize = 1
+        missSize = 2
+        while fits(missSize):
+            fitSize = missSize
+            missSize *= 2
+        while missSize - fitSize > 1:
+            testSize = (fitSize + missSize) // 2
+            if fits(testSize):
+                fitSize = testSize
+            else:
+                missSize = testSize
+        return fitSize
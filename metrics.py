@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+import contextlib, datetime, json, logging, logging.handlers, os, re, threading, time
+
+## Lightweight timing spans for each stage of a refresh. Code anywhere wraps a stage in
+##     with metrics.span('stage.name', calendar=label) as s:
+##         ...
+##         s.set(bytes=len(data))
+## and at the end of the refresh export() hands everything recorded since the last export to each exporter.
+## Spans can be recorded from any thread, so calendars fetched concurrently are timed too.
+
+class Span(object):
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = dict(attributes)
+        self.started = time.time()
+        self.seconds = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def toRecord(self):
+        record = {'name':self.name, 'started':round(self.started, 3), 'seconds':round(self.seconds, 6)}
+        record.update(self.attributes)
+        return record
+
+class MetricsRecorder(object):
+    def __init__(self):
+        self.spans = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        span = Span(name, attributes)
+        start = time.perf_counter()
+        try:
+            yield span
+        except Exception as e:
+            ## Only the type; messages can quote a calendar's URL, access token and all
+            span.set(error=type(e).__name__)
+            raise
+        finally:
+            span.seconds = time.perf_counter() - start
+            with self.lock:
+                self.spans.append(span)
+
+    ## Record something timed without a span, such as the time before this module was even imported
+    def record(self, name, seconds, **attributes):
+        span = Span(name, attributes)
+        span.started = time.time() - seconds
+        span.seconds = seconds
+        with self.lock:
+            self.spans.append(span)
+
+    ## Everything recorded so far, clearing it for the next refresh
+    def takeSpans(self):
+        with self.lock:
+            spans = self.spans
+            self.spans = []
+        return spans
+
+## Appends one JSON line per refresh, holding all of its spans, to a log that rotates once it reaches max_bytes
+class JsonLinesExporter(object):
+    def __init__(self, path, max_bytes=None, backup_count=None):
+        if max_bytes is None:
+            max_bytes = 1024*1024
+        if backup_count is None:
+            backup_count = 3
+        self.logger = logging.getLogger('metrics.{:s}'.format(path))
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        if len(self.logger.handlers) == 0:
+            handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self.logger.addHandler(handler)
+
+    def export(self, spans):
+        self.logger.info(json.dumps({'time':datetime.datetime.now().astimezone().isoformat(),
+                                     'spans':[span.toRecord() for span in spans]}))
+
+## Writes the last refresh's spans in the Prometheus text format, for node_exporter's textfile collector.
+## Spans sharing a name and calendar are summed. The file is replaced atomically so the collector never reads half of it.
+class PrometheusTextfileExporter(object):
+    def __init__(self, path, prefix=None):
+        self.path = path
+        if prefix is None:
+            prefix = 'epaper_calendar'
+        self.prefix = prefix
+
+    def export(self, spans):
+        seconds = {}
+        cacheBytes = {}
+        cacheResults = {}
+        for span in spans:
+            labels = [('stage', span.name)]
+            if 'calendar' in span.attributes:
+                labels.append(('calendar', span.attributes['calendar']))
+            labels = tuple(labels)
+            seconds[labels] = seconds.get(labels, 0) + span.seconds
+            if span.name == 'calendar_cache.get':
+                calendarLabel = (('calendar', span.attributes.get('calendar', '')),)
+                cacheBytes[calendarLabel] = span.attributes.get('bytes', 0)
+                cacheResults[calendarLabel + (('result', span.attributes.get('result', 'unknown')),)] = 1
+        lines = []
+        lines += self.__metric('stage_seconds', 'gauge', 'Time spent in each stage of the last refresh', seconds)
+        lines += self.__metric('calendar_bytes', 'gauge', 'Size of each calendar at the last refresh', cacheBytes)
+        lines += self.__metric('calendar_cache_result', 'gauge', 'How each calendar was served at the last refresh (hit, miss, revalidated or stale)', cacheResults)
+        lines += self.__metric('last_refresh_timestamp_seconds', 'gauge', 'When the last refresh finished', {(): time.time()})
+        temp_path = '{:s}.tmp'.format(self.path)
+        with open(temp_path, 'w') as outfil:
+            outfil.write('\n'.join(lines) + '\n')
+        os.replace(temp_path, self.path)
+
+    def __metric(self, name, metricType, description, values):
+        fullName = '{:s}_{:s}'.format(self.prefix, name)
+        lines = ['# HELP {:s} {:s}'.format(fullName, description), '# TYPE {:s} {:s}'.format(fullName, metricType)]
+        for labels, value in sorted(values.items()):
+            labelStr = ','.join('{:s}="{:s}"'.format(key, re.sub(r'(["\\])', r'\\\1', str(label)).replace('\n', '\\n'))
+                                for key, label in labels)
+            lines.append('{:s}{{{:s}}} {}'.format(fullName, labelStr, value) if labelStr else '{:s} {}'.format(fullName, value))
+        return lines
+
+## The process-wide recorder and exporters that the rest of the code reports to
+recorder = MetricsRecorder()
+exporters = []
+
+def span(name, **attributes):
+    return recorder.span(name, **attributes)
+
+def record(name, seconds, **attributes):
+    recorder.record(name, seconds, **attributes)
+
+def addExporter(exporter):
+    exporters.append(exporter)
+
+## Send everything recorded since the last export to each exporter; an exporter failing doesn't stop a refresh
+def export():
+    spans = recorder.takeSpans()
+    for exporter in exporters:
+        try:
+            exporter.export(spans)
+        except Exception as e:
+            print('Unable to export metrics: {}'.format(e))
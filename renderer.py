@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+import os, calendar, collections, datetime, hashlib, heapq, json, font_cache, metrics
+## PIL is only imported by what draws or loads images; working out the geometry (and so the time line's row) doesn't need it
+
+## Constraints on drawing
+edgeBuffer = 2 # pixel buffer from the edges of the e-paper
+interItemBuffer = 3 # pixel buffer between components
+calendarXSize = 0.7
+headerYSize = 0.1
+dowYSize = 0.03
+dateHeaderHeightPct = 0.15 # 15% of the height of the box
+dateHeaderWidthPct = 0.3  # two-digit dates should be 30% of the width of the box
+dateContentsBufferPct = 0.05 # 10% of the size of the box
+dateEventBoxMinimumSize = 3 # 3px of box
+dateEventBoxMaximumSize = 20 # 10px of box
+dateEventBoxMinimumSeparation = 2 # 2px of separation
+dateEventTestString = 'a few words'
+dateEventMinimumHeight = 10
+dateEventMaximumHeight = 24
+
+# colors
+foreground = 0
+background = 1
+
+## Calendar specific settings
+# 7 days in a week, maximum 5 weeks in a month
+daysInWeek = 7
+weeksInMonth = 5
+
+## Day events specific settings
+majorBlockHours = 4
+minorBlockHours = 1
+minorBlockLengthPct = 0.1 # 10% of the margins
+allDayEventHeight = 16
+timeFontHeight = 8
+dayEventFontHeight = 10
+widthDayEventsPct = 1-(minorBlockLengthPct*1.5)
+
+## Bump whenever what goes into the static layer changes, so layers cached on disk are drawn again
+static_layer_version = 1
+
+## The dates shown in the month grid for the month containing date, starting on a Sunday
+def getDatesDrawn(date):
+    cal = calendar.Calendar(6)
+    return [dateObj for dateObj in cal.itermonthdates(date.year, date.month)]
+
+## Keeps the static layer of each frame (see CalendarRenderer.getStaticLayer), which only changes with the month and
+## the number of all-day events today. Layers are kept in a small LRU and, with a cache_dir, as PNG files that survive
+## restarts; key is a string identifying everything the layer was drawn from.
+class StaticLayerCache(object):
+    def __init__(self, cache_dir=None, max_layers=None):
+        self.cache_dir = cache_dir
+        if max_layers is None:
+            max_layers = 4
+        self.max_layers = max_layers
+        self.layers = collections.OrderedDict()
+
+    def get(self, key, size):
+        if key in self.layers:
+            self.layers.move_to_end(key)
+            return self.layers[key]
+        if self.cache_dir is None:
+            return None
+        from PIL import Image
+        try:
+            with Image.open(self.__get_path(key)) as infil:
+                layer = infil.convert('1')
+        except:
+            ## If we can't load it, oh well, it will be drawn again
+            return None
+        if layer.size != size:
+            return None
+        self.__remember(key, layer)
+        return layer
+
+    def put(self, key, layer):
+        self.__remember(key, layer)
+        if self.cache_dir is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.__get_path(key)
+        temp_path = '{:s}.tmp'.format(path)
+        layer.save(temp_path, format='PNG')
+        os.replace(temp_path, path)
+
+    def __remember(self, key, layer):
+        self.layers[key] = layer
+        if len(self.layers) > self.max_layers:
+            self.layers.popitem(last=False)
+
+    def __get_path(self, key):
+        return os.path.join(self.cache_dir, '{:s}.png'.format(hashlib.sha256(key.encode()).hexdigest()))
+
+class DayEventBox(object):
+    def __init__(self, event, pixels_per_minute, currentDay, dayHeight):
+        self.event = event
+        self.startInDay = event.getStart().date() == currentDay
+        self.endInDay = event.getEnd().date() == currentDay
+        self.startHeight = 0 if not self.startInDay else int((event.getStart() - event.getStart().replace(hour=0, minute=0, second=0, microsecond=0)).total_seconds()/60*pixels_per_minute)
+        self.endHeight = dayHeight if not self.endInDay else int((event.getEnd() - event.getEnd().replace(hour=0, minute=0, second=0, microsecond=0)).total_seconds()/60*pixels_per_minute)
+    def getEvent(self):
+        return self.event
+    def getTimeSummary(self):
+        tFmt = '%I:%M%p'
+        noMinTFmt = '%I%p'
+        start = self.event.getStart()
+        end = self.event.getEnd()
+        startStr = start.strftime(tFmt) if start.minute != 0 else start.strftime(noMinTFmt)
+        endStr = end.strftime(tFmt) if end.minute != 0 else end.strftime(noMinTFmt)
+        if startStr[0] == '0':
+            startStr = startStr[1:]
+        if endStr[0] == '0':
+            endStr = endStr[1:]
+        return '{:s}-{:s} {:s}'.format(startStr, endStr, self.event.getSummary())
+    def getStartHeight(self):
+        return self.startHeight
+    def getEndHeight(self):
+        return self.endHeight
+    def startsInDay(self):
+        return self.startInDay
+    def endsInDay(self):
+        return self.endInDay
+    ## Boxes are at least a pixel tall, so events with no duration still take up room
+    def getLayoutEndHeight(self):
+        return max(self.endHeight, self.startHeight+1)
+    ## Whether the two boxes share any height; one ending exactly where the other starts isn't a conflict
+    def conflicts(self, other):
+        return (self is not other and self.getStartHeight() < other.getLayoutEndHeight()
+                and other.getStartHeight() < self.getLayoutEndHeight())
+
+## Place day event boxes side by side wherever they overlap, returning [box, column, columns] for each, in order
+## of start. Sweeping down the day, boxes chained together by overlaps form a cluster that shares its columns
+## (columns is how many the cluster needs); a heap of the active boxes' ends frees each column as its box ends,
+## and a heap of free columns hands out the leftmost one, so the whole layout is O(n log n).
+def layoutDayEventBoxes(eventBoxes):
+    placed = []
+    cluster = []
+    active = []
+    freeColumns = []
+    columnCount = 0
+    for box in sorted(eventBoxes, key=lambda box: (box.getStartHeight(), box.getLayoutEndHeight())):
+        while len(active) > 0 and active[0][0] <= box.getStartHeight():
+            heapq.heappush(freeColumns, heapq.heappop(active)[1])
+        if len(active) == 0:
+            ## Nothing is still going, so nothing after this can overlap the cluster so far
+            for entry in cluster:
+                entry[2] = columnCount
+            cluster = []
+            freeColumns = []
+            columnCount = 0
+        if len(freeColumns) > 0:
+            column = heapq.heappop(freeColumns)
+        else:
+            column = columnCount
+            columnCount += 1
+        heapq.heappush(active, (box.getLayoutEndHeight(), column))
+        entry = [box, column, None]
+        cluster.append(entry)
+        placed.append(entry)
+    for entry in cluster:
+        entry[2] = columnCount
+    return placed
+
+## Draws the calendar for a panel of the given size. Everything that depends only on the size is worked
+## out once here, so a long-lived renderer only pays for the drawing itself on each frame.
+class CalendarRenderer(object):
+    def __init__(self, width, height, fontbasedir, fonts=None, layers=None):
+        self.width = width
+        self.height = height
+        if fonts is None:
+            fonts = font_cache.FontCache()
+        self.fonts = fonts
+        if layers is None:
+            layers = StaticLayerCache()
+        self.layers = layers
+        self.majorFontName = os.path.join(fontbasedir, 'SFAlienEncountersSolid.ttf')
+        self.minorFontName = os.path.join(fontbasedir, 'Audiowide-Regular.ttf')
+        self.minimumFontName = os.path.join(fontbasedir, 'RictyDiminished-Bold.ttf')
+
+        # Overall setup
+        self.headerBounds = [edgeBuffer, edgeBuffer, int(self.width*calendarXSize)-edgeBuffer-interItemBuffer, int(self.height*headerYSize)]
+        self.calendarDoWBounds = [self.headerBounds[0], self.headerBounds[3]+interItemBuffer, self.headerBounds[2], self.headerBounds[3]+interItemBuffer+int(self.height*dowYSize)]
+        self.calendarGridBounds = [edgeBuffer, self.calendarDoWBounds[3]+interItemBuffer, self.headerBounds[2], self.height-edgeBuffer]
+        self.dayBounds = [self.calendarGridBounds[2]+interItemBuffer, edgeBuffer, self.width-edgeBuffer, self.height-edgeBuffer]
+        self.daySize = [self.dayBounds[2] - self.dayBounds[0], self.dayBounds[3] - self.dayBounds[1]]
+
+        ## Calendar specific settings
+        self.calendarGridSize = [self.calendarGridBounds[2] - self.calendarGridBounds[0], self.calendarGridBounds[3] - self.calendarGridBounds[1]]
+        self.calendarGridDaySize = [int(self.calendarGridSize[0]/float(daysInWeek)), int(self.calendarGridSize[1]/float(weeksInMonth))]
+        self.calendarGridBounds = [self.calendarGridBounds[0], self.calendarGridBounds[1], self.calendarGridBounds[0]+self.calendarGridDaySize[0]*daysInWeek, self.calendarGridBounds[1]+self.calendarGridDaySize[1]*weeksInMonth]
+        self.calendarGridXLines = [x*self.calendarGridDaySize[0] for x in range(7)]
+        self.calendarGridYLines = [y*self.calendarGridDaySize[1] for y in range(5)]
+
+        # Height of the date header on each calendar box
+        self.dateHeaderHeight = int(dateHeaderHeightPct*self.calendarGridDaySize[1])
+        # Offset from minimum box x of where the date number ends
+        self.dateHeaderWidth = int(dateHeaderWidthPct*self.calendarGridDaySize[0])
+        # How much buffer is on each side of the event contents of a date
+        self.dateContentsBufferSize = [int(dateContentsBufferPct*self.calendarGridDaySize[0]), int(dateContentsBufferPct*self.calendarGridDaySize[1])]
+        # Offset from the box x,y (upper left) of the event contents
+        self.dateContentsBounds = [self.dateContentsBufferSize[0], self.dateContentsBufferSize[1]+self.dateHeaderHeight, self.calendarGridDaySize[0]-self.dateContentsBufferSize[0], self.calendarGridDaySize[1]-self.dateContentsBufferSize[1]]
+        self.dateEventsSize = [self.dateContentsBounds[2]-self.dateContentsBounds[0], self.dateContentsBounds[3]-self.dateContentsBounds[1]]
+        self.dateEventsBottomMiddle = [int(self.dateEventsSize[0]/2)+self.dateContentsBounds[0], self.dateContentsBounds[3]-interItemBuffer]
+        # Loaded by the first render, so a renderer that's only asked about geometry never loads a font
+        self.dateHeaderFont = None
+        self.dateContentsFont = None
+
+        ## Day events specific settings
+        self.minorBlockLength = self.daySize[0]*minorBlockLengthPct/2
+        self.widthDayEvents = self.daySize[0]*widthDayEventsPct
+
+    ## Draw the month containing now, with today's events down the side, into a new image. eventIndex
+    ## has to cover every date in the month grid (see getDatesDrawn).
+    ## Only the parts that change during the month (the header, events, today's highlight and the time line)
+    ## are drawn on each call; they go over a copy of the static layer, which holds everything else.
+    def render(self, now, eventIndex):
+        from PIL import ImageDraw
+        if self.dateHeaderFont is None:
+            self.dateHeaderFont = self.fonts.getMaximumFont(self.minorFontName, [self.dateHeaderWidth-4, self.dateHeaderHeight-4], '00')
+            self.dateContentsFont = self.fonts.getMaximumFont(self.minorFontName, [self.dateEventsSize[0]-4, self.dateEventsSize[1]-4], '000')
+        curDate = now.date()
+        todayEvents = eventIndex.eventsOn(curDate)
+        allDayCount = len([event for event in todayEvents if event.isAllDay()])
+        with metrics.span('draw.static') as span:
+            timeImage = self.getStaticLayer(curDate, allDayCount, span).copy()
+        draw = ImageDraw.Draw(timeImage)
+        with metrics.span('draw.header'):
+            self.drawCalendarHeader(draw, curDate)
+
+        with metrics.span('draw.dates'):
+            for idx, dateObj in enumerate(getDatesDrawn(curDate)):
+                thisDayEvents = eventIndex.eventsOn(dateObj)
+                gridLocation = [(dateObj.weekday()+1)%7, int(idx/7)]
+                self.drawDateContents(draw, gridLocation[0], gridLocation[1],
+                          highlightHeader=curDate == dateObj,
+                          currentMonth = curDate.month == dateObj.month,
+                          events=thisDayEvents)
+
+        with metrics.span('draw.day', events=len(todayEvents)):
+            self.drawDayGrid(draw, todayEvents, curDate, now)
+        self.fonts.save()
+        return timeImage
+
+    ## Everything in a frame that only depends on the month and the number of all-day events today: the
+    ## day-of-week header, grid lines, date numbers and the marks on dates outside the month, and the
+    ## day timeline's frame and hour marks (which move down to make room for all-day events).
+    ## How it was found (memory, disk or drawn) is recorded on span.
+    def getStaticLayer(self, curDate, allDayCount, span):
+        fontNames = [self.minorFontName, self.minimumFontName]
+        key = json.dumps([static_layer_version, self.width, self.height, curDate.year, curDate.month, allDayCount,
+                          [[fontName, os.path.getmtime(fontName)] for fontName in fontNames], list(calendar.day_abbr)])
+        layer = self.layers.get(key, (self.width, self.height))
+        if layer is not None:
+            span.set(cached=True)
+            return layer
+        span.set(cached=False)
+        from PIL import Image, ImageDraw
+        layer = Image.new('1', (self.width, self.height), 1)
+        draw = ImageDraw.Draw(layer)
+        self.drawCalendarGrid(draw)
+        for idx, dateObj in enumerate(getDatesDrawn(curDate)):
+            gridLocation = [(dateObj.weekday()+1)%7, int(idx/7)]
+            self.drawDateChrome(draw, gridLocation[0], gridLocation[1], dateObj.day, currentMonth=curDate.month == dateObj.month)
+        self.drawDayChrome(draw, allDayCount)
+        self.layers.put(key, layer)
+        return layer
+
+    def drawCalendarHeader(self, draw, date):
+        upLeft = self.headerBounds[0:2]
+        dateStr = date.strftime('%B %d %Y')
+        headerSize = [(self.headerBounds[2] - self.headerBounds[0])-4, (self.headerBounds[3] - self.headerBounds[1])-4]
+        font = self.fonts.getMaximumFont(self.majorFontName, headerSize, dateStr)
+        draw.text((upLeft[0], upLeft[1]), dateStr, font=font, anchor='lt', fill=foreground)
+
+    def drawCalendarGrid(self, draw):
+        # Draw day-of-week headers
+        daysOfWeek = [dbr for dbr in calendar.day_abbr]
+        longest_day_abbreviation = daysOfWeek[daysOfWeek.index(sorted(daysOfWeek, key=lambda i: len(i), reverse=True)[0])]
+        font = self.fonts.getMaximumFont(self.minorFontName,
+                                         [self.calendarGridDaySize[0]-2, self.calendarDoWBounds[3]-self.calendarDoWBounds[1]-2],
+                                         longest_day_abbreviation)
+        for x in range(daysInWeek):
+            gridX = (x*self.calendarGridDaySize[0])+self.calendarDoWBounds[0]
+            dayOfWeek = calendar.day_abbr[(x+daysInWeek-1)%daysInWeek]
+            draw.text((gridX, self.calendarDoWBounds[1]+2), dayOfWeek, font=font, anchor='lt', fill=foreground)
+        # Draw column separators
+        for x in range(daysInWeek+1):
+            gridX = (x * self.calendarGridDaySize[0]) + self.calendarGridBounds[0]
+            draw.line([(gridX, self.calendarGridBounds[1]), (gridX, self.calendarGridBounds[3])], fill=foreground)
+        # Draw row separators
+        for y in range(weeksInMonth+1):
+            gridY = (y * self.calendarGridDaySize[1]) + self.calendarGridBounds[1]
+            draw.line([(self.calendarGridBounds[0], gridY), (self.calendarGridBounds[2], gridY)], fill=foreground)
+            # Header lines
+            if y < weeksInMonth:
+              draw.line([(self.calendarGridBounds[0], gridY + self.dateHeaderHeight), (self.calendarGridBounds[2], gridY + self.dateHeaderHeight)], fill=foreground)
+
+    ## The parts of a date's box that stay put for the month; its number, and a line through it if it's outside the month
+    def drawDateChrome(self, draw, x, y, dateNumber, currentMonth=None):
+        if currentMonth is None:
+            currentMonth = True
+        upLeft = [x*self.calendarGridDaySize[0]+self.calendarGridBounds[0], y*self.calendarGridDaySize[1]+self.calendarGridBounds[1]]
+        draw.text([upLeft[0]-2+self.dateHeaderWidth, upLeft[1]+2], str(dateNumber), font=self.dateHeaderFont, anchor='rt', fill=foreground)
+        draw.line([(upLeft[0]+self.dateHeaderWidth, upLeft[1]), (upLeft[0]+self.dateHeaderWidth, upLeft[1]+self.dateHeaderHeight)], fill=foreground)
+        if not currentMonth:
+            draw.line([(upLeft[0], upLeft[1]+self.dateHeaderHeight), (upLeft[0]+self.calendarGridDaySize[0], upLeft[1]+self.calendarGridDaySize[1])], fill=foreground)
+
+    def drawDateContents(self, draw, x, y, highlightHeader=None, events=None, currentMonth=None):
+        if highlightHeader is None:
+            highlightHeader = False
+        if currentMonth is None:
+            currentMonth = True
+        upLeft = [x*self.calendarGridDaySize[0]+self.calendarGridBounds[0], y*self.calendarGridDaySize[1]+self.calendarGridBounds[1]]
+        if highlightHeader:
+            draw.rectangle((upLeft[0]+self.dateHeaderWidth, upLeft[1], upLeft[0]+(self.calendarGridDaySize[0]), upLeft[1]+self.dateHeaderHeight), fill=foreground)
+        if events is not None and len(events) > 0 and currentMonth:
+            eventCount = len(events)
+            allDayCount = len([event for event in events if event.isAllDay()])
+            # We want a number of boxes equal to the number of events, unless we can't fit at least 3px of box and 1px of separation;
+            #  then we just output a filled rectangle with a number.
+            if self.dateEventsSize[1] < eventCount*dateEventMinimumHeight + (eventCount-1)*dateEventBoxMinimumSeparation:
+                draw.rectangle([(upLeft[0]+self.dateContentsBounds[0], upLeft[1]+self.dateContentsBounds[1]), (upLeft[0]+self.dateContentsBounds[2], upLeft[1]+self.dateContentsBounds[3])], fill=background, outline=foreground, width=2)
+                draw.text([self.dateEventsBottomMiddle[0]+upLeft[0], self.dateEventsBottomMiddle[1]+upLeft[1]], str(eventCount), font=self.dateContentsFont, anchor='mb', fill=foreground)
+            else:
+                # If we can fit it, we'll use 2xminimum separation
+                separation = dateEventBoxMinimumSeparation
+                if self.dateEventsSize[0] >= eventCount*dateEventMinimumHeight + (eventCount-1)*2*separation:
+                    separation *= 2
+                boxSize = min(max(int( (self.dateEventsSize[1]-(separation*eventCount-1))/eventCount), dateEventMinimumHeight), dateEventMaximumHeight)
+                dateEventFont = self.fonts.getMaximumFont(self.minimumFontName, [self.dateEventsSize[0], boxSize-4], dateEventTestString)
+                fontBBox = dateEventFont.getbbox(dateEventTestString)
+                boxSize = min(boxSize, fontBBox[3]-fontBBox[1]+4)
+                for yc in range(eventCount):
+                    eUpLeft = (upLeft[0]+self.dateContentsBounds[0], upLeft[1]+self.dateContentsBounds[1]+yc*(boxSize+separation))
+                    eBotRight = (upLeft[0]+self.dateContentsBounds[2], upLeft[1]+self.dateContentsBounds[1]+yc*(boxSize+separation)+boxSize)
+                    draw.rectangle([eUpLeft, eBotRight], outline=foreground, fill=background)
+                    draw.text([eUpLeft[0]+2, eUpLeft[1]+2], self.fonts.getFittedText(dateEventFont, events[yc].getSummary(), self.dateEventsSize[0]-4),
+                               font=dateEventFont, anchor='lt', fill=foreground)
+
+    ## The timeline's bounds, pushed down below the all-day events, and how many pixels each minute gets in it
+    def getDayTimelineBounds(self, numAllDayEvents):
+        reservedAllDaySpace = (allDayEventHeight*numAllDayEvents)+interItemBuffer
+        modDayBounds = [self.dayBounds[0], self.dayBounds[1]+reservedAllDaySpace, self.dayBounds[2], self.dayBounds[3]]
+        modDaySize = [self.daySize[0], modDayBounds[3]-modDayBounds[1]]
+        # intentionally left as a float, each minute is going to be subpixels
+        # but in case we need to coerce something that's not aligned to a 15 minute boundary
+        pixels_per_minute = modDaySize[1]/float(24*60.0)
+        return modDayBounds, pixels_per_minute
+
+    ## The pixel row the current time line is drawn on. It only moves every few minutes, so two frames for the
+    ## same date, events and row are identical.
+    def getTimeLineHeight(self, currentTime, numAllDayEvents):
+        modDayBounds, pixels_per_minute = self.getDayTimelineBounds(numAllDayEvents)
+        return int((currentTime-currentTime.replace(hour=0, minute=0, second=0, microsecond=0)).total_seconds()/60*pixels_per_minute)+modDayBounds[1]
+
+    def drawDayGrid(self, draw, todayEvents, currentDay, currentTime):
+        allDayEvents = [event for event in todayEvents if event.isAllDay()]
+        duringDayEvents = [event for event in todayEvents if not event.isAllDay()]
+        numAllDayEvents = len(allDayEvents)
+        modDayBounds, pixels_per_minute = self.getDayTimelineBounds(numAllDayEvents)
+        # All day events
+        if numAllDayEvents > 0:
+            font = self.fonts.getMaximumFont(self.minimumFontName, [self.daySize[0]-4, allDayEventHeight-4], dateEventTestString)
+            for idx, event in enumerate(sorted(allDayEvents, key=lambda event: event.getSummary())):
+                height = self.dayBounds[1]+idx*allDayEventHeight
+                draw.rectangle([ (self.dayBounds[0], height), (self.dayBounds[2], height+allDayEventHeight) ],  fill=background, outline=foreground)
+                draw.text([self.dayBounds[0]+2, height+2], self.fonts.getFittedText(font, event.getSummary(), self.daySize[0]-4), font=font, anchor='lt', fill=foreground)
+        self.drawDayEvents(draw, duringDayEvents, modDayBounds[1], currentDay, pixels_per_minute)
+        currentTimeHeight = self.getTimeLineHeight(currentTime, numAllDayEvents)
+        draw.line([(self.dayBounds[0], currentTimeHeight), (self.dayBounds[2], currentTimeHeight)], fill=foreground)
+
+    ## The timeline's frame and hour marks
+    def drawDayChrome(self, draw, numAllDayEvents):
+        modDayBounds, pixels_per_minute = self.getDayTimelineBounds(numAllDayEvents)
+        draw.rectangle([(modDayBounds[0], modDayBounds[1]), (modDayBounds[2], modDayBounds[3])], width=2, fill=background, outline=foreground)
+        # Minor hour marks
+        for hblock in range(24):
+            height = modDayBounds[1]+int(pixels_per_minute*hblock*60)
+            # left side
+            draw.line([ (modDayBounds[0], height), (modDayBounds[0]+self.minorBlockLength, height) ], fill=foreground)
+            # right side
+            draw.line([ (modDayBounds[2]-self.minorBlockLength, height), (modDayBounds[2], height) ], fill=foreground)
+        # Major hour marks
+        hourFont = self.fonts.getMaximumFont(self.minimumFontName, [self.daySize[0]-4, timeFontHeight], '12Noon')
+        for hblock in range(int(24/majorBlockHours)):
+            height = modDayBounds[1]+int(pixels_per_minute*hblock*majorBlockHours*60)
+            draw.line([ (modDayBounds[0], height), (modDayBounds[2], height) ], fill=foreground)
+            if hblock != 0:
+              time = datetime.time(hour=hblock*4)
+              formatted = time.strftime('%I%p') if time.hour != 12 else 'Noon'
+              if formatted[0] == '0':
+                  formatted = formatted[1:]
+              textbb = hourFont.getbbox(formatted, anchor='lm')
+              draw.rectangle([ (modDayBounds[0]+2, height+textbb[1]), (modDayBounds[0]+6+textbb[2], height+textbb[3])], fill=background)
+              draw.text([modDayBounds[0]+4, height], formatted, font=hourFont, anchor='lm', fill=foreground)
+
+    def drawDayEvents(self, draw, events, midnight_y, currentDay, pixels_per_minute):
+        # Events running past midnight stop at the bottom of the timeline, not the bottom of the day area
+        timelineHeight = int(24*60*pixels_per_minute)
+        eventBoxes = [DayEventBox(event, pixels_per_minute, currentDay, timelineHeight) for event in events]
+        upLeft = [self.dayBounds[0]+int(self.daySize[0]/2-(self.widthDayEvents/2)), midnight_y]
+        font = self.fonts.getMaximumFont(self.minimumFontName, [self.daySize[0]-4, dayEventFontHeight], dateEventTestString)
+        for event, column, columns in layoutDayEventBoxes(eventBoxes):
+            # With too many columns to separate, they're packed edge to edge, and too narrow for text
+            separation = dateEventBoxMinimumSeparation if self.widthDayEvents > columns*(dateEventBoxMinimumSeparation+1) else 0
+            boxWidth = (self.widthDayEvents-((columns-1)*separation))/columns
+            eUpLeft = (upLeft[0]+(column*(boxWidth+separation)), event.getStartHeight()+midnight_y)
+            eDownRight = (upLeft[0]+(column*(boxWidth+separation))+boxWidth, event.getEndHeight()+midnight_y)
+            draw.rectangle([ eUpLeft, eDownRight ], fill=background, outline=foreground)
+            if boxWidth > 4:
+                draw.text([eUpLeft[0]+2, eUpLeft[1]+2], self.fonts.getFittedText(font, event.getTimeSummary(), boxWidth-4),
+                          font=font, anchor='lt', fill=foreground)